@@ -7,20 +7,22 @@
 
 import numpy as np
 import xarray as xr
+import dask
 import dask.array as da
 from dask.diagnostics import ProgressBar
 from xeofs.single import EOF, EOFRotator
 import scipy.signal as signal
 import pandas as pd
 from datetime import datetime, timedelta
+from functools import partial
 import os
 import sys
 
 
-precip_clim = xr.open_dataset('precip_clim_hindcast_1993-2015_regrid.nc')['tot_precip'].sel(lat=slice(30.5, -12.5), lon=slice(60.5, 95.5)).mean('lon')
+precip_clim = xr.open_dataset('precip_clim_hindcast_1993-2015_regrid.nc')['tot_precip'].sel(lat=slice(30.5, -12.5), lon=slice(60.5, 95.5)).mean('lon').astype('float32')
 
 
-olr_clim = xr.open_dataset('climatology_olr_1x1.nc')['olr'].sortby('lat', ascending=False).sel(lat=slice(40.5, -30.5), lon=slice(30.5, 180.5)).squeeze()
+olr_clim = xr.open_dataset('climatology_olr_1x1.nc')['olr'].sortby('lat', ascending=False).sel(lat=slice(40.5, -30.5), lon=slice(30.5, 180.5)).squeeze().astype('float32')
 n_days = olr_clim.sizes['time']
 
 start_date = '2000-01-01' if n_days == 366 else '2001-01-01'
@@ -72,45 +74,104 @@ def prepare_data_for_eeof(data: xr.DataArray, tau: int, embedding: int, time_dim
 
     n_times_original = data.sizes[time_dim]
 
-
     shifts = np.arange(embedding) * tau
 
-    shifted_data_list = []
-    for i in shifts:
+    n_samples_cut = (embedding - 1) * tau
 
-        shifted_copy = data.shift({time_dim: -int(i)})
-        shifted_data_list.append(shifted_copy)
+    if n_samples_cut >= n_times_original:
+         raise ValueError(
+             f"Cannot cut {n_samples_cut} samples from data with only "
+             f"{n_times_original} time steps. "
+             f"Resulting number of samples would be non-positive. "
+             f"Check tau ({tau}) and embedding ({embedding})."
+         )
 
+    n_valid = n_times_original - n_samples_cut
 
-    X_extended = xr.concat(shifted_data_list, dim="embedding")
+    data = data.transpose(time_dim, ...)
 
+    # Zero-copy (n_valid, *features, window) view of the time axis; every tau-th
+    # sample in the window is one lagged copy, so lag e*tau is window[..., e].
+    if tau > 0:
+        window = np.lib.stride_tricks.sliding_window_view(data.values, window_shape=n_samples_cut + 1, axis=0)[..., ::tau]
+    else:
+        window = np.broadcast_to(data.values[..., np.newaxis], data.shape + (embedding,))
+    lagged = np.moveaxis(window, -1, 0)
 
-    X_extended = X_extended.assign_coords({"embedding": shifts})
+    template = data.isel({time_dim: slice(0, n_valid)})
 
+    X_trimmed = xr.DataArray(
+        lagged,
+        dims=("embedding",) + template.dims,
+        coords=template.coords,
+        name=data.name,
+        attrs=data.attrs,
+    ).assign_coords({"embedding": shifts})
 
-    n_samples_cut = (embedding - 1) * tau
+    return X_trimmed
 
-    if n_samples_cut > 0:
 
-        if n_samples_cut >= n_times_original:
-             raise ValueError(
-                 f"Cannot cut {n_samples_cut} samples from data with only "
-                 f"{n_times_original} time steps. "
-                 f"Resulting number of samples would be non-positive. "
-                 f"Check tau ({tau}) and embedding ({embedding})."
-             )
 
-        X_trimmed = X_extended.isel({time_dim: slice(None, -n_samples_cut)})
-    elif n_samples_cut == 0:
 
-         X_trimmed = X_extended
-    else:
-         raise ValueError("Internal error: Invalid n_samples_cut calculation.")
+def preprocess_forecast(ds: xr.Dataset, var: str, window_start: str, window_end: str) -> xr.Dataset:
+    """
+    Reduces one forecast file to the zonally averaged (time, lat) field used for the MISO scores.
 
+    Intended as the ``preprocess`` hook of ``xr.open_mfdataset`` so that all
+    ensemble members are opened and reduced in a single lazy dask graph.
 
-    return X_trimmed
+    Parameters:
+        ds (xr.Dataset): Forecast dataset as written by convert_to_nc_extract_both_forecast.sh.
+        var (str): Name of the variable to keep (e.g., 'tot_precip' or 'olr').
+        window_start (str): First day of the verification window, YYYYMMDD.
+        window_end (str): Last day of the verification window, YYYYMMDD.
 
+    Returns:
+        xr.Dataset: Dataset holding only ``var`` as float32 with dimensions (time, lat).
+    """
+    return ds[[var]].rename({'t':'time', 'latitude':'lat', 'longitude':'lon'}).drop_vars(['surface'], errors='ignore')\
+        .sel(time=slice(window_start, window_end)).mean(('lon')).squeeze().astype('float32')
+
+
+def subtract_climatology(data: xr.DataArray, clim: xr.DataArray, time_dim: str = 'time') -> xr.DataArray:
+    """
+    Removes a dayofyear climatology from data using a positional NumPy gather.
+
+    The climatology is looked up once per time step with an integer index into
+    its underlying array instead of label-based ``clim.sel(dayofyear=...)``.
+    Shared feature dimensions (e.g., 'lat') must carry identical labels, as after
+    ``reindex``; climatology dimensions absent from data are broadcast, as the
+    label-based subtraction would.
 
+    Parameters:
+        data (xr.DataArray): Input data with a time dimension, e.g., (ensemble, time, lat).
+        clim (xr.DataArray): Climatology with a 'dayofyear' dimension, e.g., (dayofyear, lat).
+        time_dim (str): The name of the time dimension in data.
+
+    Returns:
+        xr.DataArray: Anomalies with the dimensions and coordinates of data, followed
+                      by any climatology dimensions that data lacks.
+
+    Raises:
+        KeyError: If a day of year in data is missing from the climatology.
+        ValueError: If a shared feature dimension has different labels in data and clim.
+    """
+    day_of_year = data[time_dim].dt.dayofyear.values
+    doy_index = clim.get_index('dayofyear').get_indexer(day_of_year)
+    if (doy_index < 0).any():
+        raise KeyError(f"Days of year {np.unique(day_of_year[doy_index < 0])} not found in climatology.")
+
+    feature_dims = [dim for dim in clim.dims if dim != 'dayofyear']
+    for dim in feature_dims:
+        if dim in data.dims and not np.array_equal(data[dim].values, clim[dim].values):
+            raise ValueError(f"Coordinate '{dim}' of data and climatology differ; reindex the climatology first.")
+
+    clim_on_time = clim.transpose('dayofyear', *feature_dims).values[doy_index]
+
+    result_dims = data.dims + tuple(dim for dim in feature_dims if dim not in data.dims)
+    data = data.expand_dims({dim: clim[dim].values for dim in feature_dims if dim not in data.dims})
+    data = data.transpose(..., time_dim, *feature_dims)
+    return data.copy(data=data.data - clim_on_time).transpose(*result_dims)
 
 
 def get_latest_thursday(input_date):
@@ -136,106 +197,112 @@ forecast_date = latest_thursday_date.strftime("%Y%m%dT0000Z")
 
 
 
-initial = [(datetime.strptime(forecast_date, "%Y%m%dT%H%MZ") - timedelta(days=i)).strftime("%Y%m%dT0000Z") for i in range(4, 0, -1)]
+initial_dates = [latest_thursday_date - timedelta(days=i) for i in range(4, 0, -1)]
+initial = [ini_dt.strftime("%Y%m%dT0000Z") for ini_dt in initial_dates]
 members = ['mem1', 'mem2', 'mem3', 'mem4']
 
-precip_forecast_anom = {}
-
-
-for num, ini in enumerate(initial):
-    precip_forecast_anom[ini] = {}
-    initial_date = datetime.strptime(ini, "%Y%m%dT%H%MZ").strftime("%Y%m%d")
-    end_date     = (datetime.strptime(ini, "%Y%m%dT%H%MZ") + timedelta(days=18)).strftime("%Y%m%d")
+# Each initial condition is verified over the same window: ini + (4 - num) days is
+# the forecast date for every ini, and ini + (35 - num) days is 31 days later.
+# The members are stacked with join='exact' below, so one whose time axis differs
+# fails loudly instead of being padded with NaN.
+window_start = latest_thursday_date.strftime("%Y%m%d")
+window_end   = (latest_thursday_date + timedelta(days=31)).strftime("%Y%m%d")
+
+ensemble = []
+precip_paths = []
+olr_paths = []
+for ini, ini_dt in zip(initial, initial_dates):
+    initial_date = ini_dt.strftime("%Y%m%d")
+    end_date     = (ini_dt + timedelta(days=18)).strftime("%Y%m%d")
     for member in members:
-        forecast_path = os.path.join(os.path.expanduser("~"), "forecast/prediction", f'{ini}/{member}/1/concatenated_{initial_date}_{end_date}_{member}.nc')
+        forecast_path = os.path.join(os.path.expanduser("~"), "forecast/prediction", f'{ini}/{member}/1/concatenated_{initial_date}_{end_date}_{member}')
+        ensemble.append(f'{ini}_{member}')
+        precip_paths.append(f'{forecast_path}.nc')
+        olr_paths.append(f'{forecast_path}_OLR.nc')
 
-        precip_forecast = xr.open_dataset(forecast_path)['tot_precip']\
-            .rename({'t':'time', 'latitude':'lat', 'longitude':'lon'}).drop_vars(['surface'], errors='ignore')\
-            .sel(time=slice((datetime.strptime(ini, "%Y%m%dT%H%MZ") + timedelta(days=4-num)).strftime("%Y%m%d"), \
-            (datetime.strptime(ini, "%Y%m%dT%H%MZ") + timedelta(days=35-num)).strftime("%Y%m%d"))).mean(('lon')).squeeze()
-        # precip_forecast = xr.where(precip_forecast<0, 0, precip_forecast)
-        day_of_year = precip_forecast['time'].dt.dayofyear
-        precip_clim = precip_clim.reindex(lat=precip_forecast.lat, method='nearest')
-        precip_forecast_anom[ini][member] = precip_forecast - precip_clim.sel(dayofyear=day_of_year)
-        print(precip_forecast_anom[ini][member].isnull().any())
+ensemble = pd.Index(ensemble, name='ensemble')
 
 
+precip_forecast = xr.open_mfdataset(precip_paths, preprocess=partial(preprocess_forecast, var='tot_precip', window_start=window_start, window_end=window_end),
+                                    combine='nested', concat_dim='ensemble', join='exact', coords='minimal', compat='override',
+                                    parallel=True, chunks={'t': -1})['tot_precip'].assign_coords(ensemble=ensemble)
+# precip_forecast = xr.where(precip_forecast<0, 0, precip_forecast)
+precip_clim = precip_clim.reindex(lat=precip_forecast.lat, method='nearest')
+precip_forecast_anom = subtract_climatology(precip_forecast, precip_clim)
 
-print ('1\n\n\n')
 
 
+print ('1\n\n\n')
 
 
-olr_forecast_anom = {}
 
 
-for num, ini in enumerate(initial):
-    olr_forecast_anom[ini] = {}
-    initial_date = datetime.strptime(ini, "%Y%m%dT%H%MZ").strftime("%Y%m%d")
-    end_date     = (datetime.strptime(ini, "%Y%m%dT%H%MZ") + timedelta(days=18)).strftime("%Y%m%d")
-    for member in members:
-        forecast_path = os.path.join(os.path.expanduser("~"), "forecast/prediction", f'{ini}/{member}/1/concatenated_{initial_date}_{end_date}_{member}_OLR.nc')
+olr_forecast = xr.open_mfdataset(olr_paths, preprocess=partial(preprocess_forecast, var='olr', window_start=window_start, window_end=window_end),
+                                 combine='nested', concat_dim='ensemble', join='exact', coords='minimal', compat='override',
+                                 parallel=True, chunks={'t': -1})['olr'].assign_coords(ensemble=ensemble)
+olr_clim = olr_clim_grouped.reindex(lat=olr_forecast.lat, method='nearest')
+olr_forecast_anom = subtract_climatology(olr_forecast, olr_clim)
 
-        olr_forecast = xr.open_dataset(forecast_path)['olr']\
-            .rename({'t':'time', 'latitude':'lat', 'longitude':'lon'}).drop_vars(['surface'], errors='ignore')\
-            .sel(time=slice((datetime.strptime(ini, "%Y%m%dT%H%MZ") + timedelta(days=4-num)).strftime("%Y%m%d"), \
-            (datetime.strptime(ini, "%Y%m%dT%H%MZ") + timedelta(days=35-num)).strftime("%Y%m%d"))).mean(('lon')).squeeze()
-        # precip_forecast = xr.where(precip_forecast<0, 0, precip_forecast)
-        day_of_year = olr_forecast['time'].dt.dayofyear
-        olr_clim = olr_clim_grouped.reindex(lat=olr_forecast.lat, method='nearest')
-        olr_forecast_anom[ini][member] = olr_forecast - olr_clim_grouped.sel(dayofyear=day_of_year)
-        print(olr_forecast_anom[ini][member].isnull().any())
+# Every member is its own chunk along 'ensemble', so persisting both variables in
+# one call runs all 32 independent open + subtract pipelines in a single pass, and
+# only once rather than on every later use. Worker processes are used because the
+# HDF5 library lock would serialise the file reads on the threaded scheduler; they
+# are forked, as spawned workers would re-run this unguarded script on import.
+with dask.config.set({'multiprocessing.context': 'fork'}):
+    precip_forecast_anom, olr_forecast_anom = dask.persist(precip_forecast_anom, olr_forecast_anom,
+                                                           scheduler='processes', num_workers=min(16, os.cpu_count() or 1))
 
 
-initial_date = (datetime.strptime(forecast_date, "%Y%m%dT%H%MZ") + timedelta(days=-16)).strftime("%Y%m%d")
-end_date     = (datetime.strptime(forecast_date, "%Y%m%dT%H%MZ") + timedelta(days=-1)).strftime("%Y%m%d")
+initial_date = (latest_thursday_date + timedelta(days=-16)).strftime("%Y%m%d")
+end_date     = (latest_thursday_date + timedelta(days=-1)).strftime("%Y%m%d")
 
-precip_lag_1 =  xr.open_dataset(f'avg_precip_analysis_output/prate_daily_avg_{initial_date}_to_{end_date}_regrid.nc')['PRATE_surface'].sel(lat=slice(30.5, -12.5), lon=slice(60.5, 95.5)).mean(('lon'))[2:]
+precip_lag_1 =  xr.open_dataset(f'avg_precip_analysis_output/prate_daily_avg_{initial_date}_to_{end_date}_regrid.nc')['PRATE_surface'].sel(lat=slice(30.5, -12.5), lon=slice(60.5, 95.5)).mean(('lon'))[2:].astype('float32')
 
 precip_lag_1 = precip_lag_1.reindex(lat=precip_clim.lat, method='nearest')
-doy = precip_lag_1['time'].dt.dayofyear
-precip_lag = precip_lag_1 - precip_clim.sel(dayofyear=doy)
+precip_lag = subtract_climatology(precip_lag_1, precip_clim)
 
+print(*dask.compute(precip_forecast_anom.isnull().any(), olr_forecast_anom.isnull().any(), precip_lag.isnull().any()))
 
-eeofs = xr.open_dataset('EEOFS_MISO_1997_2016_GPCP_v1.3.nc')['miso_eeofs']
+
+eeofs = xr.open_dataset('EEOFS_MISO_1997_2016_GPCP_v1.3.nc')['miso_eeofs'].astype('float32')
 
 eeofs = eeofs.reindex(lat=precip_clim.lat, method='nearest')
 
-miso_scores_std = xr.open_dataset('Obs_MISO_scores_std_JJAS.nc')["miso_scores_std"]
+miso_scores_std = xr.open_dataset('Obs_MISO_scores_std_JJAS.nc')["miso_scores_std"].astype('float32')
 
 
 print ('2\n\n\n')
 
-precip_concat = {}
+# Flatten the EEOFs once to a (mode, embedding*lat) matrix and fold in the score
+# standardisation, so each projection below is a single GEMM giving standardised scores.
+# NaNs are zero-filled to keep the skipna behaviour of (eeofs*lagged).sum().
+n_modes = eeofs.sizes['mode']
+miso_scores_std = miso_scores_std.sel(mode=eeofs['mode'])
+projection = (np.nan_to_num(eeofs.transpose('mode', 'embedding', 'lat').values.reshape(n_modes, -1), nan=0.0)
+              / miso_scores_std.values[:, None]).astype(np.float32)
 
-precip_miso_lagged = {}
-miso1_score = {}
-miso2_score = {}
-for ini in initial:
-    precip_concat[ini] = {}
-    precip_miso_lagged[ini] = {}
-    miso1_score[ini] = {}
-    miso2_score[ini] = {}
-    for member in members:
-        precip_concat[ini][member] = xr.concat((precip_lag, precip_forecast_anom[ini][member]), dim='time')
-        print(precip_concat[ini][member].isnull().any())
-        precip_miso_lagged[ini][member] = prepare_data_for_eeof(precip_concat[ini][member], tau = 1, embedding = 15, time_dim = 'time')
-        # print(precip_miso_lagged[ini][member].isnull().sum()) 
-        miso_scores = (eeofs*precip_miso_lagged[ini][member]).sum(dim=['embedding', 'lat'])/miso_scores_std
-        # miso1_score.time = precip_forecast_anom[ini][member].time
-        miso_scores = miso_scores.assign_coords(time=precip_forecast_anom[ini][member].time)
-        miso1_score[ini][member] = miso_scores[0]
-        miso2_score[ini][member] = miso_scores[1]
-        miso1_score[ini][member].name = f'MISO1_{ini[:8]}_{member}'
-        miso2_score[ini][member].name = f'MISO2_{ini[:8]}_{member}'
+# Prepend the observed lag period to every member at once and embed the whole
+# (time, ensemble, lat) block in one call.
+precip_concat = xr.concat((precip_lag.expand_dims(ensemble=precip_forecast_anom['ensemble']), precip_forecast_anom), dim='time')
+precip_miso_lagged = prepare_data_for_eeof(precip_concat, tau = 1, embedding = 15, time_dim = 'time')
+# print(precip_miso_lagged.isnull().sum())
+# .values drops labels, so the embedding/lat labels must match the EEOFs exactly.
+xr.align(eeofs, precip_miso_lagged, join='exact', exclude=['mode', 'time', 'ensemble'])
+
+# Score every member with one GEMM: (mode, embedding*lat) @ (embedding*lat, ensemble*time).
+lagged = precip_miso_lagged.transpose('embedding', 'lat', 'ensemble', 'time')
+n_members, n_times = lagged.sizes['ensemble'], lagged.sizes['time']
+lagged_matrix = np.nan_to_num(lagged.values.reshape(-1, n_members * n_times), nan=0.0)
+scores = (projection @ lagged_matrix).reshape(n_modes, n_members, n_times)
+
+miso_scores = xr.DataArray(scores, dims=('mode', 'ensemble', 'time'),
+                           coords={'mode': eeofs['mode'].values, 'ensemble': lagged['ensemble'].values, 'time': precip_forecast_anom['time'].values})
 
 
-combined_miso1 = xr.Dataset(
-    {f'MISO1_{ini}_{member}': miso1_score[ini][member].drop_vars('dayofyear', errors='ignore') for ini in miso1_score for member in miso1_score[ini]}
-)
-combined_miso2 = xr.Dataset(
-    {f'MISO2_{ini}_{member}': miso2_score[ini][member].drop_vars('dayofyear', errors='ignore') for ini in miso2_score for member in miso2_score[ini]}
-)
+# Keep the two leading modes as MISO1/MISO2 and write them as one compressed
+# (ensemble, time, mode) variable instead of one small variable per member and mode.
+miso = miso_scores.isel(mode=[0, 1]).assign_coords(mode=[1, 2]).transpose('ensemble', 'time', 'mode').astype('float32')
+combined_miso = xr.Dataset({'miso': miso})
 
 
 
@@ -244,20 +311,17 @@ directory = os.path.join(os.path.expanduser("~"), "forecast", "MISOs")
 if not os.path.exists(directory):
     os.makedirs(directory)
 
-file_path_1 = os.path.join(directory, f'MISO1_CNCUM_IC_{initial[0][:8]}-{initial[-1][:8]}_FC_{forecast_date[:8]}.nc')
-file_path_2 = os.path.join(directory, f'MISO2_CNCUM_IC_{initial[0][:8]}-{initial[-1][:8]}_FC_{forecast_date[:8]}.nc')
+file_path = os.path.join(directory, f'MISO_CNCUM_IC_{initial[0][:8]}-{initial[-1][:8]}_FC_{forecast_date[:8]}.nc')
 
 
 
-if os.path.exists(file_path_1):
-    os.remove(file_path_1)
-if os.path.exists(file_path_2):
-    os.remove(file_path_2)
+if os.path.exists(file_path):
+    os.remove(file_path)
 
 
 
 
 
 
-combined_miso1.to_netcdf(file_path_1, mode='w')
-combined_miso2.to_netcdf(file_path_2, mode='w')
\ No newline at end of file
+combined_miso.to_netcdf(file_path, mode='w', engine='h5netcdf',
+                        encoding={'miso': {'dtype': 'float32', 'zlib': True, 'chunksizes': miso.shape}})
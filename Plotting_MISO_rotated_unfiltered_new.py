@@ -11,6 +11,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 import xarray as xr
 from matplotlib.animation import FuncAnimation
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
 import pandas as pd
 from datetime import datetime, timedelta
 import os
@@ -34,7 +38,6 @@ def set_up_rmm_phase_diagram_axes(fig, draw_axes_tick_labels=True, draw_axes_tit
     axrmm = fig.add_subplot(1, 1, 1)
 
     theta = np.linspace(0, 2 * np.pi, 361)
-    axrmm.plot(np.cos(theta), np.sin(theta), 'k', linewidth=2, linestyle='--')
 
     lines = [
         ([-4.0, -1.0], [0.0, 0.0]),
@@ -46,9 +49,12 @@ def set_up_rmm_phase_diagram_axes(fig, draw_axes_tick_labels=True, draw_axes_tit
         ([-4.0, -0.707], [4.0, 0.707]),
         ([0.707, 4.0], [-0.707, -4.0]),
     ]
-    
-    for i, (x, y) in enumerate(lines):
-        axrmm.plot(x, y, 'k', linewidth=2, linestyle='--')
+
+    # Unit circle and phase dividers as one path: each piece starts with a MOVETO.
+    verts = np.concatenate([np.column_stack([np.cos(theta), np.sin(theta)])] + [np.column_stack([x, y]) for x, y in lines])
+    codes = np.full(len(verts), Path.LINETO, dtype=Path.code_type)
+    codes[np.cumsum([0, len(theta)] + [2] * (len(lines) - 1))] = Path.MOVETO
+    axrmm.add_patch(PathPatch(Path(verts, codes), fill=False, edgecolor='k', linewidth=2, linestyle='--', zorder=2))
 
 
     if draw_axes_tick_labels:
@@ -103,74 +109,40 @@ def add_rmm_index_trace(RMM, axrmm, linewidth=2, alpha=1.0, max_gap_days=7):
     handles missing data (gaps) and NaT values in the time index, and uses the color
     of the *coming* month for the connecting line.
     """
-    rmm1keep = RMM['MISO1']
-    rmm2keep = RMM['MISO2']
-    time_index = pd.to_datetime(RMM['MISO1']['time'], errors='coerce')
-    months = time_index.month
-    years = time_index.year
+    rmm1keep = np.asarray(RMM['MISO1'].values)
+    rmm2keep = np.asarray(RMM['MISO2'].values)
+    time_index = pd.DatetimeIndex(pd.to_datetime(RMM['MISO1']['time'].values, errors='coerce'))
+    months = np.asarray(time_index.month)
 
     month_colors = {
         1: 'r', 2: 'g', 3: 'b', 4: 'r', 5: 'g', 6: 'b',
         7: 'r', 8: 'g', 9: 'b', 10: 'r', 11: 'g', 12: 'b'
     }
 
-    for month in range(1, 13):
-        mask = (months == month)
-        month_indices = np.where(mask)[0]
+    # One segment per pair of consecutive days. Segments inside a month are always
+    # drawn; a segment into the next month only if the time gap is small enough.
+    points = np.column_stack([rmm1keep, rmm2keep])
+    segments = np.stack([points[:-1], points[1:]], axis=1)
 
-        if len(month_indices) == 0:
-            continue
+    valid = np.asarray(~time_index.isna())
+    gap_days = np.asarray((time_index[1:] - time_index[:-1]).days, dtype=float)
+    same_month = months[1:] == months[:-1]
+    keep = valid[:-1] & valid[1:] & (same_month | (gap_days <= max_gap_days))
 
-        month_start_index = month_indices[0]
-        month_end_index = month_indices[-1]
+    if not keep.any():
+        return
 
-
-        if pd.isnull(time_index[month_end_index]):
-            print(f"Skipping month {month} connection due to NaT value at the end of the month.")
-            continue
-
-        axrmm.plot(
-            rmm1keep[month_start_index:month_end_index + 1],
-            rmm2keep[month_start_index:month_end_index + 1],
-            color=month_colors[month],
-            linewidth=linewidth,
-            alpha=alpha
-        )
-
-        if month < 12:
-            next_month = month + 1
-            next_month_mask = (months == next_month) & (years == years[month_end_index])
-        else:
-            next_month = 1
-            next_month_mask = (months == next_month) & (years == years[month_end_index] + 1)
-
-        next_month_indices = np.where(next_month_mask)[0]
-
-        if len(next_month_indices) > 0:
-            next_month_start_index = next_month_indices[0]
-
-
-            if pd.isnull(time_index[next_month_start_index]):
-                print(f"Skipping connection to next month due to NaT value at beginning of next month.")
-                continue
-
-
-            if (time_index[next_month_start_index] - time_index[month_end_index]).days <= max_gap_days:
-                axrmm.plot(
-                    [rmm1keep[month_end_index], rmm1keep[next_month_start_index]],
-                    [rmm2keep[month_end_index], rmm2keep[next_month_start_index]],
-                    color=month_colors[next_month],
-                    linewidth=linewidth,
-                    alpha=alpha
-                )
+    colors = to_rgba_array([month_colors[int(month)] for month in months[1:][keep]])
+    axrmm.add_collection(LineCollection(segments[keep], colors=colors, linewidths=linewidth, alpha=alpha))
+    axrmm.autoscale_view()
 
 
 def add_rmm_index_trace_animation(RMM, axrmm, save_path='mjo_phase_diagram.gif', dpi=450):
-    rmm1keep = RMM['MISO1']
-    rmm2keep = RMM['MISO2']
-    time_index = pd.to_datetime(RMM['MISO1']['time'], errors='coerce')
-    months = time_index.month
-    years = time_index.year
+    rmm1keep = np.asarray(RMM['MISO1'].values)
+    rmm2keep = np.asarray(RMM['MISO2'].values)
+    time_index = pd.DatetimeIndex(pd.to_datetime(RMM['MISO1']['time'].values, errors='coerce'))
+    months = np.asarray(time_index.month)
+    years = np.asarray(time_index.year)
 
     month_colors = {
         1: 'r', 2: 'g', 3: 'b', 4: 'r', 5: 'g', 6: 'b',
@@ -225,15 +197,16 @@ def add_rmm_index_trace_animation(RMM, axrmm, save_path='mjo_phase_diagram.gif',
         if frame < len(rmm1keep):
             scatter.set_offsets(np.c_[rmm1keep[:frame + 1], rmm2keep[:frame + 1]])
 
-            for idx in range(frame + 1):
-                current_date_str = time_index[idx].strftime('%d')
-                date_texts[idx].set_position((rmm1keep[idx], rmm2keep[idx] + 0.02))
-                date_texts[idx].set_text(current_date_str)
+            # Labels of earlier frames never change, so only the new one is placed.
+            date_texts[frame].set_position((rmm1keep[frame], rmm2keep[frame] + 0.02))
+            date_texts[frame].set_text(time_index[frame].strftime('%d'))
 
             current_title_date = time_index[frame].strftime('%Y-%m-%d')
             axrmm.set_title(f'16 member forecast starting {time_index[0].strftime("%Y%m%d")}\non: {current_title_date}', fontsize=15, fontweight='bold')
 
-        return scatter, *date_texts
+        # Blitting restores a clean background each frame, so every label placed
+        # so far is still returned to be redrawn.
+        return scatter, *date_texts[:frame + 1]
 
     ani = FuncAnimation(
         plt.gcf(), update, frames=len(rmm1keep), interval=100, blit=True
@@ -273,13 +246,12 @@ forecast_date = latest_thursday_date.strftime("%Y%m%dT0000Z")
 
 
 
-initial = [(datetime.strptime(forecast_date, "%Y%m%dT0000Z") - timedelta(days=i)).strftime("%Y%m%dT0000Z") for i in range(4, 0, -1)]
+initial = [(latest_thursday_date - timedelta(days=i)).strftime("%Y%m%dT0000Z") for i in range(4, 0, -1)]
 members = ['mem1', 'mem2', 'mem3', 'mem4']
 
 directory = os.path.join(os.path.expanduser("~"), "forecast", "MISOs")
 
-file_path_1 = os.path.join(directory, f'MISO1_CNCUM_IC_{initial[0][:8]}-{initial[-1][:8]}_FC_{forecast_date[:8]}.nc')
-file_path_2 = os.path.join(directory, f'MISO2_CNCUM_IC_{initial[0][:8]}-{initial[-1][:8]}_FC_{forecast_date[:8]}.nc')
+file_path = os.path.join(directory, f'MISO_CNCUM_IC_{initial[0][:8]}-{initial[-1][:8]}_FC_{forecast_date[:8]}.nc')
 
 directory = os.path.join(os.path.expanduser("~"), "forecast", "Plots")
 if not os.path.exists(directory):
@@ -293,19 +265,16 @@ plot_path = os.path.join(directory, f'miso_phase_diagram_cncum_forecast_{forecas
 
 
 
-miso1_total = 0
-miso2_total = 0
+miso = xr.open_dataset(file_path)['miso']
+
+ensemble = miso['ensemble'].values
 
-for ini in initial:
-    for member in members:
-        miso1_data = xr.open_dataset(file_path_1)[f'MISO1_{ini}_{member}']
-        miso2_data = xr.open_dataset(file_path_2)[f'MISO2_{ini}_{member}']        
-        miso1_total += miso1_data
-        miso2_total += miso2_data
+miso1_ensemble = miso.sel(mode=1)
+miso2_ensemble = miso.sel(mode=2)
 
-num_entries = len(initial) * len(members)
-miso1_average = miso1_total / num_entries
-miso2_average = miso2_total / num_entries
+miso_average = miso.mean('ensemble', skipna=False)
+miso1_average = miso_average.sel(mode=1)
+miso2_average = miso_average.sel(mode=2)
 
 
 fig = plt.figure(figsize=(8, 8))
@@ -321,18 +290,17 @@ month_names = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
                'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
 
 
-for ini in initial:
-    for member in members:
-        miso1_data = xr.open_dataset(file_path_1)[f'MISO1_{ini}_{member}']
-        miso2_data = xr.open_dataset(file_path_2)[f'MISO2_{ini}_{member}']
+for name in ensemble:
+    miso1_data = miso1_ensemble.sel(ensemble=name)
+    miso2_data = miso2_ensemble.sel(ensemble=name)
 
-        print(miso1_data.isnull().sum(), ini, member)
+    print(miso1_data.isnull().sum(), *name.split('_'))
 
-        RMM = {'MISO1': miso1_data, 'MISO2': miso2_data}
-        add_rmm_index_trace(RMM, axrmm, linewidth=1, alpha=0.3, max_gap_days=7)
-        time_index = pd.to_datetime(miso1_data['time'].values, errors='coerce')
-        months = time_index.month
-        available_months.update(months)
+    RMM = {'MISO1': miso1_data, 'MISO2': miso2_data}
+    add_rmm_index_trace(RMM, axrmm, linewidth=1, alpha=0.3, max_gap_days=7)
+    time_index = pd.to_datetime(miso1_data['time'].values, errors='coerce')
+    months = time_index.month
+    available_months.update(months)
 
 
 legend_handles = [plt.Line2D([0], [0], color=month_colors[i], lw=4) for i in available_months]